@@ -1,76 +1,166 @@
+import functools
+import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import comfy.model_management
 import comfy.model_patcher
 import folder_paths
 import torch
-from transformers import AutoModelForCausalLM, AutoProcessor, AutoTokenizer
+from packaging import version
+from transformers import AutoModelForCausalLM, AutoProcessor, AutoTokenizer, BitsAndBytesConfig, StaticCache
 from .nodes_registry import comfy_node
-from .prompt_enhancer_utils import generate_cinematic_prompt
+from .prompt_enhancer_utils import MAX_PROMPT_LENGTH, generate_cinematic_prompt, generate_image_captions
 
 # 检查是否支持 4-bit 量化
 try:
+    import bitsandbytes
     from bitsandbytes.nn import Linear4bit
 except ImportError:
+    bitsandbytes = None
     Linear4bit = None
 
+# 更早版本的 bitsandbytes 不支持移动 4-bit 模型：transformers 的 .to 会直接报 ValueError，
+# ComfyUI 通过 nn.Module.to 换出再换入时则会把已经打包好的 uint8 权重重新量化一遍，得到错误的结果
+MIN_BNB_VERSION_FOR_4BIT_MOVE = "0.43.2"
+
+def _get_offload_device(model, load_device, offload_device):
+    if getattr(model, "is_loaded_in_4bit", False) and version.parse(
+        bitsandbytes.__version__
+    ) < version.parse(MIN_BNB_VERSION_FOR_4BIT_MOVE):
+        logger.warning(
+            "bitsandbytes>=%s is required to offload 4-bit %s, keeping it on %s",
+            MIN_BNB_VERSION_FOR_4BIT_MOVE,
+            type(model).__name__,
+            load_device,
+        )
+        return load_device
+    return offload_device
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
 LLM_NAME = ["unsloth/Llama-3.2-3B-Instruct"]
 IMAGE_CAPTIONER = ["MiaoshouAI/Florence-2-large-PromptGen-v2.0"]
 MODELS_PATH_KEY = "LLM"
+DEFAULT_MAX_RESULTING_TOKENS = 256
+MAX_RESULTING_TOKENS = 512
+STATIC_CACHE_LENGTH = MAX_PROMPT_LENGTH + MAX_RESULTING_TOKENS
+
+# 每个进程只检查/下载一次模型目录
+@functools.lru_cache(maxsize=None)
+def _ensure_local_path(model_name):
+    model_directory = os.path.join(folder_paths.models_dir, MODELS_PATH_KEY)
+    os.makedirs(model_directory, exist_ok=True)
+    model_name_ = model_name.rsplit("/", 1)[-1]
+    model_path = os.path.join(model_directory, model_name_)
+
+    if not os.path.exists(model_path):
+        from huggingface_hub import snapshot_download
+        try:
+            snapshot_download(repo_id=model_name, local_dir=model_path, local_dir_use_symlinks=False, endpoint="https://hf-mirror.com")
+        except Exception:
+            shutil.rmtree(model_path, ignore_errors=True)
+            raise
+    return model_path
 
-class PromptEnhancer(torch.nn.Module):
+# 分词器和处理器不随模型卸载，重复加载节点时直接复用
+@functools.lru_cache(maxsize=None)
+def _load_llm_tokenizer(model_path):
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, mirror="https://hf-mirror.com")
+    if not tokenizer.is_fast:
+        raise ValueError(f"Expected a fast tokenizer in {model_path}")
+    return tokenizer
+
+@functools.lru_cache(maxsize=None)
+def _load_image_caption_processor(model_path):
+    return AutoProcessor.from_pretrained(
+        model_path,
+        trust_remote_code=True,
+        mirror="https://hf-mirror.com"
+    )
+
+class PromptEnhancerComponent(torch.nn.Module):
+    def __init__(self, model: AutoModelForCausalLM, reserved_memory: int = 0):
+        super().__init__()
+        self.model = model
+        self.model_size = self.get_model_size(self.model) + reserved_memory
+
+    @staticmethod
+    def get_model_size(model):
+        total_size = sum(p.numel() * p.element_size() for p in model.parameters())
+        total_size += sum(b.numel() * b.element_size() for b in model.buffers())
+        # bnb 4-bit 权重的 absmax（以及 double quant 的二级状态）存在 quant_state 里，不在 parameters() 中
+        total_size += sum(
+            PromptEnhancerComponent.get_quant_state_size(getattr(p, "quant_state", None))
+            for p in model.parameters()
+        )
+        return total_size
+
+    @staticmethod
+    def get_quant_state_size(quant_state):
+        if quant_state is None:
+            return 0
+        total_size = 0
+        for name in ("absmax", "code", "offset"):
+            tensor = getattr(quant_state, name, None)
+            if isinstance(tensor, torch.Tensor):
+                total_size += tensor.numel() * tensor.element_size()
+        return total_size + PromptEnhancerComponent.get_quant_state_size(getattr(quant_state, "state2", None))
+
+    def memory_required(self, input_shape):
+        return self.model_size
+
+# 图像描述模型和 LLM 是先后运行的，分别用各自的 ModelPatcher 管理，
+# 这样同一时刻只需要其中一个在显存里
+class PromptEnhancer:
     def __init__(
         self,
         image_caption_processor: AutoProcessor,
-        image_caption_model: AutoModelForCausalLM,
-        llm_model: AutoModelForCausalLM,
+        image_caption_patcher: comfy.model_patcher.ModelPatcher,
+        llm_patcher: comfy.model_patcher.ModelPatcher,
         llm_tokenizer: AutoTokenizer,
+        static_cache: StaticCache = None,
     ):
-        super().__init__()
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.image_caption_processor = image_caption_processor
-        self.image_caption_model = image_caption_model
-        self.llm_model = llm_model
+        self.image_caption_patcher = image_caption_patcher
+        self.llm_patcher = llm_patcher
         self.llm_tokenizer = llm_tokenizer
-        
-        self.model_size = (
-            self.get_model_size(self.image_caption_model)
-            + self.get_model_size(self.llm_model)
-            + 1073741824
+        # 批量生成需要左侧补齐，Llama 没有 pad token，用 eos 代替
+        self.llm_tokenizer.padding_side = "left"
+        if self.llm_tokenizer.pad_token is None:
+            self.llm_tokenizer.pad_token = self.llm_tokenizer.eos_token
+        self.static_cache = static_cache
+
+    @property
+    def image_caption_model(self):
+        return self.image_caption_patcher.model.model
+
+    @property
+    def llm_model(self):
+        return self.llm_patcher.model.model
+
+    def caption(self, image_conditioning, caption_max_tokens=128, caption_num_beams=1):
+        return generate_image_captions(
+            self.image_caption_model,
+            self.image_caption_processor,
+            image_conditioning,
+            caption_max_tokens,
+            caption_num_beams,
         )
 
-    def forward(self, prompt, image_conditioning, max_resulting_tokens):
-        if image_conditioning is not None:
-            dtype = next(self.image_caption_model.parameters()).dtype
-            image_conditioning = [
-                (
-                    tensor.to(self.device, dtype=dtype),
-                    pos,
-                    weight
-                ) 
-                for tensor, pos, weight in image_conditioning
-            ]
-        
+    def generate(self, prompt, image_captions, max_resulting_tokens):
         enhanced_prompt_list = generate_cinematic_prompt(
             self.image_caption_model,
             self.image_caption_processor,
             self.llm_model,
             self.llm_tokenizer,
             prompt,
-            image_conditioning,
             max_new_tokens=max_resulting_tokens,
+            static_cache=self.static_cache,
+            image_captions=image_captions,
         )
         return enhanced_prompt_list[0]
 
-    @staticmethod
-    def get_model_size(model):
-        total_size = sum(p.numel() * p.element_size() for p in model.parameters())
-        total_size += sum(b.numel() * b.element_size() for b in model.buffers())
-        return total_size
-
-    def memory_required(self, input_shape):
-        return self.model_size
-
 @comfy_node(name="LTXVPromptEnhancerLoader")
 class LTXVPromptEnhancerLoader:
     @classmethod
@@ -79,6 +169,8 @@ class LTXVPromptEnhancerLoader:
             "required": {
                 "llm_name": ("STRING", {"default": LLM_NAME[0], "tooltip": "LLM model name."}),
                 "image_captioner_name": ("STRING", {"default": IMAGE_CAPTIONER[0], "tooltip": "Image captioning model name."}),
+                "quantize_captioner": ("BOOLEAN", {"default": True, "tooltip": "Load the image captioner's language decoder in 4-bit NF4 to save VRAM. Offloading it needs bitsandbytes>=0.43.2."}),
+                "compile": ("BOOLEAN", {"default": False, "tooltip": "torch.compile the LLM decode step with a static KV cache. The first load is slower."}),
             }
         }
 
@@ -90,74 +182,166 @@ class LTXVPromptEnhancerLoader:
     OUTPUT_NODE = False
 
     def model_path_download_if_needed(self, model_name):
-        model_directory = os.path.join(folder_paths.models_dir, MODELS_PATH_KEY)
-        os.makedirs(model_directory, exist_ok=True)
-        model_name_ = model_name.rsplit("/", 1)[-1]
-        model_path = os.path.join(model_directory, model_name_)
-
-        if not os.path.exists(model_path):
-            from huggingface_hub import snapshot_download
-            try:
-                snapshot_download(repo_id=model_name, local_dir=model_path, local_dir_use_symlinks=False, endpoint="https://hf-mirror.com")
-            except Exception:
-                shutil.rmtree(model_path, ignore_errors=True)
-                raise
-        return model_path
+        return _ensure_local_path(model_name)
 
-    def down_load_llm_model(self, load_device):
+    def down_load_llm_model(self, load_device, static_cache=False):
         model_path = self.model_path_download_if_needed(LLM_NAME[0])
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            available_memory = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)
-            if available_memory < 4e9:
-                comfy.model_management.unload_all_models()
 
         quantization_config = None
         if Linear4bit is not None and torch.cuda.is_available():
-            quantization_config = {"load_in_4bit": True, "bnb_4bit_compute_dtype": torch.float16}
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
 
-        llm_model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float16,
+        # 量化时非量化部分（词嵌入、norm、lm_head）也用 bf16，和 4-bit 层的计算精度一致，避免每层来回转换
+        llm_kwargs = dict(
+            torch_dtype=torch.bfloat16 if quantization_config else torch.float16,
             device_map="auto" if quantization_config else {"": load_device},
             quantization_config=quantization_config,
             mirror="https://hf-mirror.com"
         )
-        llm_tokenizer = AutoTokenizer.from_pretrained(model_path, mirror="https://hf-mirror.com")
+        # 优先使用 Flash-Attention 2，未安装 flash-attn 时回退到 SDPA。
+        # FA2 不支持 static cache，编译模式下直接用 SDPA；
+        # FA2 只支持 Ampere 及更新的 GPU，老显卡上加载能成功但每次 generate 都会报错，所以直接用 SDPA
+        use_flash_attention = (
+            not static_cache
+            and torch.device(load_device).type == "cuda"
+            and torch.cuda.get_device_capability(load_device)[0] >= 8
+        )
+        llm_model = None
+        if use_flash_attention:
+            try:
+                llm_model = AutoModelForCausalLM.from_pretrained(
+                    model_path, attn_implementation="flash_attention_2", **llm_kwargs
+                )
+            except (ImportError, ValueError):
+                pass
+        if llm_model is None:
+            llm_model = AutoModelForCausalLM.from_pretrained(
+                model_path, attn_implementation="sdpa", **llm_kwargs
+            )
+        llm_tokenizer = _load_llm_tokenizer(model_path)
         return llm_model, llm_tokenizer
 
-    def down_load_image_captioner(self, load_device):
+    def down_load_image_captioner(self, load_device, quantize_captioner=True):
         model_path = self.model_path_download_if_needed(IMAGE_CAPTIONER[0])
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            available_memory = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)
-            if available_memory < 6e9:
-                comfy.model_management.unload_all_models()
+
+        # 只量化语言解码器，视觉塔保持 fp16（image_projection 是 nn.Parameter 而不是 Linear，本来就不会被量化）。
+        # 指定 llm_int8_skip_modules 会替换掉 transformers 默认跳过 lm_head 的逻辑，
+        # 而 lm_head 和共享词嵌入是绑定的，所以要显式跳过；不同版本按短名或完整路径匹配，两种都写上
+        quantization_config = None
+        if quantize_captioner and Linear4bit is not None and torch.cuda.is_available():
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.float16,
+                llm_int8_skip_modules=["vision_tower", "lm_head", "language_model.lm_head"],
+            )
 
         image_caption_model = AutoModelForCausalLM.from_pretrained(
             model_path,
             trust_remote_code=True,
             torch_dtype=torch.float16,
             device_map={"": load_device},
+            quantization_config=quantization_config,
+            attn_implementation="sdpa",
             mirror="https://hf-mirror.com"
         )
-        image_caption_processor = AutoProcessor.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-            mirror="https://hf-mirror.com"
-        )
+        image_caption_processor = _load_image_caption_processor(model_path)
         return image_caption_model, image_caption_processor
 
-    def load(self, llm_name, image_captioner_name):
+    def create_static_cache(self, llm_model, load_device):
+        # 按最长提示词加最大输出长度一次性分配，任何一次调用都不需要重新分配 cache
+        return StaticCache(
+            config=llm_model.config,
+            max_batch_size=1,
+            max_cache_len=STATIC_CACHE_LENGTH,
+            device=load_device,
+            dtype=llm_model.dtype,
+        )
+
+    @staticmethod
+    def get_static_cache_size(llm_model):
+        # 每层各有一份 key 和 value：[batch, kv_heads, cache_len, head_dim]
+        config = llm_model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        element_size = torch.empty((), dtype=llm_model.dtype).element_size()
+        return config.num_hidden_layers * 2 * num_kv_heads * STATIC_CACHE_LENGTH * head_dim * element_size
+
+    def compile_llm_model(self, enhancer):
+        llm_model = enhancer.llm_model
+        eager_forward = llm_model.forward
+        # bnb Linear4bit 会产生 graph break，fullgraph=True 会直接报错
+        compiled_forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+
+        # 只编译 decode step：它的输入（单个 token、固定大小的 static cache 和 4D mask）形状不变。
+        # prefill 的长度随提示词变化，编译它会为每个长度各捕获一份 CUDA graph，所以用 eager 跑
+        def forward(*args, **kwargs):
+            input_ids = kwargs["input_ids"] if "input_ids" in kwargs else (args[0] if args else None)
+            if (
+                input_ids is not None
+                and input_ids.shape[1] == 1
+                and kwargs.get("past_key_values") is enhancer.static_cache
+            ):
+                return compiled_forward(*args, **kwargs)
+            return eager_forward(*args, **kwargs)
+
+        llm_model.forward = forward
+        # 捕获的 CUDA graph 绑定了权重的显存地址，free_memory 换出再换入 LLM 之后，下一次调用会重新录制一遍
+        # decode step 的形状和提示词长度无关，任意提示词预热都能让编译和 CUDA graph 捕获发生在加载阶段
+        enhancer.generate("A man walks down the street.", None, DEFAULT_MAX_RESULTING_TOKENS)
+
+    def load(self, llm_name, image_captioner_name, quantize_captioner=True, compile=False):
         load_device = "cuda:0" if torch.cuda.is_available() else "cpu"
         offload_device = comfy.model_management.vae_offload_device()
         
-        llm_model, llm_tokenizer = self.down_load_llm_model(load_device)
-        image_caption_model, image_caption_processor = self.down_load_image_captioner(load_device)
+        # 两个模型一起加载前先检查一次显存，不够就先卸载其他模型
+        if torch.cuda.is_available():
+            available_memory = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)
+            if available_memory < 6e9:
+                comfy.model_management.unload_all_models()
+
+        # 只并行下载；from_pretrained 会临时修改进程级状态（默认 dtype 等），不是线程安全的，必须依次加载
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(self.model_path_download_if_needed, [LLM_NAME[0], IMAGE_CAPTIONER[0]]))
+
+        llm_model, llm_tokenizer = self.down_load_llm_model(load_device, static_cache=compile)
+        image_caption_model, image_caption_processor = self.down_load_image_captioner(load_device, quantize_captioner)
+        # 不能移动的 4-bit 模型把 load_device 当作 offload 设备交给 ModelPatcher，
+        # 这样 ComfyUI 知道它一直占着显存，也不会尝试把它换出去
+        image_caption_offload_device = _get_offload_device(image_caption_model, load_device, offload_device)
+        llm_offload_device = _get_offload_device(llm_model, load_device, offload_device)
+        # 图像描述模型只在有图像输入时由 load_model_gpu 放到显存，平时留在 offload 设备上
+        image_caption_model.to(image_caption_offload_device)
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
-        enhancer = PromptEnhancer(image_caption_processor, image_caption_model, llm_model, llm_tokenizer)
-        patcher = comfy.model_patcher.ModelPatcher(enhancer, load_device, offload_device)
-        return (patcher,)
+        image_caption_patcher = comfy.model_patcher.ModelPatcher(
+            PromptEnhancerComponent(image_caption_model, reserved_memory=268435456),  # 预留 256MB 给激活
+            load_device,
+            image_caption_offload_device,
+        )
+        # 编译模式下的 static cache 常驻 load_device，不随 LLM 换出，算进 LLM 的预留显存里让 ComfyUI 能统计到；
+        # decode 的 CUDA graph 内存池只放单个 token 的激活，包含在 512MB 的预留里
+        llm_reserved_memory = 536870912  # NF4 权重占用更小，预留 512MB 给激活和 KV cache
+        static_cache = None
+        if compile:
+            static_cache = self.create_static_cache(llm_model, load_device)
+            llm_reserved_memory += self.get_static_cache_size(llm_model)
+        llm_patcher = comfy.model_patcher.ModelPatcher(
+            PromptEnhancerComponent(llm_model, reserved_memory=llm_reserved_memory),
+            load_device,
+            llm_offload_device,
+        )
+        enhancer = PromptEnhancer(image_caption_processor, image_caption_patcher, llm_patcher, llm_tokenizer, static_cache=static_cache)
+        if compile:
+            self.compile_llm_model(enhancer)
+        return (enhancer,)
 
 @comfy_node(name="LTXVPromptEnhancer")
 class LTXVPromptEnhancer:
@@ -167,7 +351,9 @@ class LTXVPromptEnhancer:
             "required": {
                 "prompt": ("STRING",),
                 "prompt_enhancer": ("LTXV_PROMPT_ENHANCER",),
-                "max_resulting_tokens": ("INT", {"default": 256, "min": 32, "max": 512}),
+                "max_resulting_tokens": ("INT", {"default": DEFAULT_MAX_RESULTING_TOKENS, "min": 32, "max": MAX_RESULTING_TOKENS}),
+                "caption_max_tokens": ("INT", {"default": 128, "min": 16, "max": 1024, "tooltip": "Maximum number of tokens in the image caption."}),
+                "caption_num_beams": ("INT", {"default": 1, "min": 1, "max": 5, "tooltip": "Beam search width for the image caption. 1 means greedy decoding."}),
             },
             "optional": {
                 "image_prompt": ("IMAGE",),
@@ -181,24 +367,51 @@ class LTXVPromptEnhancer:
     TITLE = "LTXV Prompt Enhancer"
     OUTPUT_NODE = False
 
-    def enhance(self, prompt, prompt_enhancer: comfy.model_patcher.ModelPatcher, image_prompt: torch.Tensor = None, max_resulting_tokens=256):
-        comfy.model_management.free_memory(prompt_enhancer.memory_required([]), comfy.model_management.get_torch_device())
-        comfy.model_management.load_model_gpu(prompt_enhancer)
-        model = prompt_enhancer.model
-        
-        image_conditioning = None
+    def enhance(self, prompt, prompt_enhancer: PromptEnhancer, image_prompt: torch.Tensor = None, max_resulting_tokens=256, caption_max_tokens=128, caption_num_beams=1):
+        device = comfy.model_management.get_torch_device()
+        image_caption_patcher = prompt_enhancer.image_caption_patcher
+
+        copy_stream = None
         if image_prompt is not None:
-            dtype = next(model.image_caption_model.parameters()).dtype
-            image_prompt = image_prompt.to(model.device, dtype=dtype)
-            print(f"image_prompt shape: {image_prompt.shape}")  # 调试输出
+            load_device = torch.device(image_caption_patcher.load_device)
+            dtype = next(prompt_enhancer.image_caption_model.parameters()).dtype
+            # 只在这里转换一次设备和精度，后续不再重复复制
+            if image_prompt.device.type == "cpu" and load_device.type == "cuda":
+                # 锁页内存 + 独立 CUDA stream 异步拷贝，和下面加载模型权重的过程重叠
+                if not image_prompt.is_pinned():
+                    image_prompt = image_prompt.pin_memory()
+                # 先原样拷贝，精度转换放到 GPU 上做；带 dtype 的 .to 会先在 CPU 上转换成新的可分页张量
+                copy_stream = torch.cuda.Stream(device=load_device)
+                with torch.cuda.stream(copy_stream):
+                    image_prompt = image_prompt.to(load_device, non_blocking=True)
+            else:
+                image_prompt = image_prompt.to(load_device, dtype=dtype)
+
+        image_captions = None
+        # 纯文本提示词用不到图像描述模型，不必把它加载到显存
+        if image_prompt is not None:
+            comfy.model_management.free_memory(image_caption_patcher.memory_required([]), device)
+            comfy.model_management.load_model_gpu(image_caption_patcher)
+
+            if copy_stream is not None:
+                torch.cuda.current_stream(copy_stream.device).wait_stream(copy_stream)
+                image_prompt.record_stream(torch.cuda.current_stream(copy_stream.device))
+                image_prompt = image_prompt.to(dtype)
+            logger.debug("image_prompt shape: %s", image_prompt.shape)
             if image_prompt.dim() == 4 and image_prompt.shape[-1] in [3, 4]:
                 image_prompt = image_prompt.permute(0, 3, 1, 2)  # [B, H, W, C] -> [B, C, H, W]
-                print(f"image_prompt after permute: {image_prompt.shape}")  # 调试输出
+                logger.debug("image_prompt after permute: %s", image_prompt.shape)
             # 确保张量为 5 维 [B, C, F, H, W]，F=1 表示单帧
             if image_prompt.dim() == 4:
                 image_prompt = image_prompt.unsqueeze(2)  # [B, C, H, W] -> [B, C, 1, H, W]
-                print(f"image_prompt after unsqueeze: {image_prompt.shape}")  # 调试输出
+                logger.debug("image_prompt after unsqueeze: %s", image_prompt.shape)
             image_conditioning = [(image_prompt, 0, 1.0)]
-        
-        enhanced_prompt = model(prompt, image_conditioning, max_resulting_tokens)
-        return (enhanced_prompt,)
\ No newline at end of file
+            image_captions = prompt_enhancer.caption(image_conditioning, caption_max_tokens, caption_num_beams)
+
+        # 显存不够同时放下两个模型时，free_memory 会把图像描述模型换出去
+        llm_patcher = prompt_enhancer.llm_patcher
+        comfy.model_management.free_memory(llm_patcher.memory_required([]), device)
+        comfy.model_management.load_model_gpu(llm_patcher)
+
+        enhanced_prompt = prompt_enhancer.generate(prompt, image_captions, max_resulting_tokens)
+        return (enhanced_prompt,)
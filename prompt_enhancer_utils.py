@@ -1,13 +1,23 @@
 import logging
 import random
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from PIL import Image
-import numpy as np
+from transformers import StaticCache
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# 提示词（系统提示词 + 用户输入 + 生成头）的最大 token 数
+MAX_PROMPT_LENGTH = 2048
+
+# 系统提示词前缀的分词结果，按分词器 id 和系统提示词缓存，在第一次使用时填充
+_prefix_cache: Dict[int, Dict[str, dict]] = {}
+
+# 图像描述任务提示词的分词结果，按处理器 id 和任务 token 缓存
+_caption_prompt_cache: Dict[Tuple[int, str], torch.Tensor] = {}
+
 T2V_CINEMATIC_PROMPT = """You are an expert cinematic director with many award winning movies, When writing prompts based on the user input, focus on detailed, chronological descriptions of actions and scenes.
 Include specific movements, appearances, camera angles, and environmental details - all in a single flowing paragraph.
 Start directly with the action, and keep descriptions literal and precise.
@@ -56,7 +66,7 @@ Output the enhanced prompt only.
 """
 
 def tensor_to_pil(tensor):
-    print(f"tensor shape in tensor_to_pil: {tensor.shape}")  # 调试输出
+    logger.debug("tensor shape in tensor_to_pil: %s", tensor.shape)
     # 确保张量至少有 3 维 (C, H, W)
     if tensor.dim() < 3:
         raise ValueError(f"Tensor must have at least 3 dimensions (C, H, W), got {tensor.shape}")
@@ -71,19 +81,19 @@ def tensor_to_pil(tensor):
     if tensor.dim() != 3:
         raise ValueError(f"Expected 3D tensor (C, H, W) after processing, got {tensor.shape}")
     
-    # 确保值在 [-1, 1] 范围内
-    if tensor.min() < -1 or tensor.max() > 1:
-        tensor = tensor.clamp(-1, 1)
-    
-    # Convert from [-1, 1] to [0, 1]
-    tensor = (tensor + 1) / 2
-
-    # Rearrange from [C, H, W] to [H, W, C]
-    tensor = tensor.permute(1, 2, 0)
-
-    # Convert to numpy array and then to uint8 range [0, 255]
-    numpy_image = (tensor.cpu().numpy() * 255).astype(np.uint8)
-    print(f"numpy_image shape: {numpy_image.shape}")  # 调试输出
+    # 一次性完成 [-1, 1] 截断、映射到 [0, 255] 和 [C, H, W] -> [H, W, C]
+    # clamp 不原地修改，避免改动调用方的张量；之后的原地操作都作用在新张量上
+    numpy_image = (
+        tensor.clamp(-1, 1)
+        .add_(1)
+        .mul_(127.5)
+        .to(torch.uint8)
+        .permute(1, 2, 0)
+        .contiguous()
+        .cpu()
+        .numpy()
+    )
+    logger.debug("numpy_image shape: %s", numpy_image.shape)
 
     # 确保通道数正确
     if numpy_image.shape[-1] not in [1, 3, 4]:
@@ -91,6 +101,7 @@ def tensor_to_pil(tensor):
 
     return Image.fromarray(numpy_image)
 
+@torch.inference_mode()
 def generate_cinematic_prompt(
     image_caption_model,
     image_caption_processor,
@@ -99,56 +110,87 @@ def generate_cinematic_prompt(
     prompt: Union[str, List[str]],
     conditioning_items: Optional[List[Tuple[torch.Tensor, int, float]]] = None,
     max_new_tokens: int = 256,
+    static_cache: Optional[StaticCache] = None,
+    caption_max_tokens: int = 128,
+    caption_num_beams: int = 1,
+    image_captions: Optional[List[str]] = None,
 ) -> List[str]:
     prompts = [prompt] if isinstance(prompt, str) else prompt
 
-    if conditioning_items is None:
+    if image_captions is None and conditioning_items is not None:
+        image_captions = generate_image_captions(
+            image_caption_model,
+            image_caption_processor,
+            conditioning_items,
+            caption_max_tokens,
+            caption_num_beams,
+        )
+
+    if image_captions is None:
         prompts = _generate_t2v_prompt(
             prompt_enhancer_model,
             prompt_enhancer_tokenizer,
             prompts,
             max_new_tokens,
             T2V_CINEMATIC_PROMPT,
+            static_cache,
         )
     else:
-        dtype = next(image_caption_model.parameters()).dtype
-        conditioning_items = [
-            (
-                tensor.to(prompt_enhancer_model.device, dtype=dtype),
-                pos,
-                weight
-            )
-            for tensor, pos, weight in conditioning_items
-        ]
-
-        first_frame_conditioning_item = conditioning_items[0]
-        first_frames = _get_first_frames_from_conditioning_item(
-            first_frame_conditioning_item
-        )
-
-        assert len(first_frames) == len(
+        assert len(image_captions) == len(
             prompts
         ), "Number of conditioning frames must match number of prompts"
 
         prompts = _generate_i2v_prompt(
-            image_caption_model,
-            image_caption_processor,
             prompt_enhancer_model,
             prompt_enhancer_tokenizer,
             prompts,
-            first_frames,
+            image_captions,
             max_new_tokens,
             I2V_CINEMATIC_PROMPT,
+            static_cache,
         )
 
     return prompts
 
+@torch.inference_mode()
+def generate_image_captions(
+    image_caption_model,
+    image_caption_processor,
+    conditioning_items: List[Tuple[torch.Tensor, int, float]],
+    caption_max_tokens: int = 128,
+    caption_num_beams: int = 1,
+) -> List[str]:
+    # 调用方通常已经转换好设备和精度，只在不一致时才复制
+    device = image_caption_model.device
+    dtype = next(image_caption_model.parameters()).dtype
+    if any(tensor.device != device or tensor.dtype != dtype for tensor, _, _ in conditioning_items):
+        conditioning_items = [
+            (
+                tensor.to(device, dtype=dtype),
+                pos,
+                weight
+            )
+            for tensor, pos, weight in conditioning_items
+        ]
+
+    first_frame_conditioning_item = conditioning_items[0]
+    first_frames = _get_first_frames_from_conditioning_item(
+        first_frame_conditioning_item
+    )
+
+    return _generate_image_captions(
+        image_caption_model,
+        image_caption_processor,
+        first_frames,
+        max_new_tokens=caption_max_tokens,
+        num_beams=caption_num_beams,
+    )
+
 def _get_first_frames_from_conditioning_item(
     conditioning_item: Tuple[torch.Tensor, int, float]
-) -> List[Image.Image]:
+) -> torch.Tensor:
     frames_tensor = conditioning_item[0]
-    print(f"frames_tensor shape: {frames_tensor.shape}")  # 调试输出
-    
+
     # 验证张量维度
     if frames_tensor.dim() != 5:
         raise ValueError(f"Expected frames_tensor with 5 dimensions [B, C, F, H, W], got {frames_tensor.shape}")
@@ -159,131 +201,283 @@ def _get_first_frames_from_conditioning_item(
     if height < 1 or width < 1:
         raise ValueError(f"Invalid spatial dimensions: height={height}, width={width}")
 
-    return [
-        tensor_to_pil(frames_tensor[i, :, 0, :, :])  # 取第一帧
-        for i in range(batch_size)
+    return frames_tensor[:, :, 0, :, :]  # 取第一帧 [B, C, H, W]
+
+def _get_system_prompt_prefix(
+    prompt_enhancer_tokenizer, system_prompt: str, refresh: bool = False
+) -> dict:
+    tokenizer_cache = _prefix_cache.setdefault(id(prompt_enhancer_tokenizer), {})
+    prefix = tokenizer_cache.get(system_prompt)
+    if prefix is not None and not refresh:
+        return prefix
+
+    text = prompt_enhancer_tokenizer.apply_chat_template(
+        [{"role": "system", "content": system_prompt}], tokenize=False
+    )
+    input_ids = prompt_enhancer_tokenizer(
+        text, add_special_tokens=False, return_tensors="pt"
+    ).input_ids
+    attention_mask = torch.ones_like(input_ids)
+    # 锁页内存上的张量可以异步拷贝到显存
+    if torch.cuda.is_available():
+        input_ids = input_ids.pin_memory()
+        attention_mask = attention_mask.pin_memory()
+    prefix = {"text": text, "input_ids": input_ids, "attention_mask": attention_mask}
+    tokenizer_cache[system_prompt] = prefix
+    return prefix
+
+def _tokenize_chat(
+    prompt_enhancer_tokenizer,
+    system_prompt: str,
+    user_contents: List[str],
+    device: torch.device,
+) -> Dict[str, torch.Tensor]:
+    # Llama 3 的聊天模板会对内容做 trim，先去掉首尾空白，下面才能在渲染结果里找到原样的内容
+    user_contents = [content.strip() for content in user_contents]
+    texts = [
+        prompt_enhancer_tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        for content in user_contents
     ]
 
+    prefix = _get_system_prompt_prefix(prompt_enhancer_tokenizer, system_prompt)
+    # 模板渲染结果变化（例如模板里的日期）时才重新渲染并分词前缀
+    if not all(t.startswith(prefix["text"]) for t in texts):
+        prefix = _get_system_prompt_prefix(prompt_enhancer_tokenizer, system_prompt, refresh=True)
+        if not all(t.startswith(prefix["text"]) for t in texts):
+            prefix = None
+
+    prefix_length = 0
+    if prefix is not None:
+        texts = [t[len(prefix["text"]) :] for t in texts]
+        prefix_length = prefix["input_ids"].shape[1]
+
+    # 把每一行拆成用户内容之前（含内容）和之后的模板尾部（<|eot_id|> 和 assistant 生成头），
+    # 超长时只截断用户内容，保证总长度不超过 MAX_PROMPT_LENGTH 且生成头完整
+    bodies, tails = [], []
+    for text, content in zip(texts, user_contents):
+        end = text.rfind(content)
+        end = len(text) if end < 0 else end + len(content)
+        bodies.append(text[:end])
+        tails.append(text[end:])
+
+    # 文本已经包含模板里的特殊 token，不要再额外加 BOS
+    body_ids = prompt_enhancer_tokenizer(bodies, add_special_tokens=False).input_ids
+    tail_ids = prompt_enhancer_tokenizer(tails, add_special_tokens=False).input_ids
+    budget = MAX_PROMPT_LENGTH - prefix_length
+    rows = [b[: max(budget - len(t), 0)] + t for b, t in zip(body_ids, tail_ids)]
+    model_inputs = prompt_enhancer_tokenizer.pad(
+        {"input_ids": rows}, padding=True, return_tensors="pt"
+    ).to(device)
+    input_ids = model_inputs["input_ids"]
+    attention_mask = model_inputs["attention_mask"]
+
+    if prefix is not None:
+        # 补齐位置夹在前缀和用户输入之间，由 attention_mask 屏蔽
+        batch_size = input_ids.shape[0]
+        prefix_ids = prefix["input_ids"].to(device, non_blocking=True).expand(batch_size, -1)
+        prefix_mask = prefix["attention_mask"].to(device, non_blocking=True).expand(batch_size, -1)
+        input_ids = torch.cat([prefix_ids, input_ids], dim=1)
+        attention_mask = torch.cat([prefix_mask, attention_mask], dim=1)
+
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
 def _generate_t2v_prompt(
     prompt_enhancer_model,
     prompt_enhancer_tokenizer,
     prompts: List[str],
     max_new_tokens: int,
     system_prompt: str,
+    static_cache: Optional[StaticCache] = None,
 ) -> List[str]:
-    messages = [
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"user_prompt: {p}"},
-        ]
-        for p in prompts
-    ]
-
-    texts = [
-        prompt_enhancer_tokenizer.apply_chat_template(
-            m, tokenize=False, add_generation_prompt=True
-        )
-        for m in messages
-    ]
-    model_inputs = prompt_enhancer_tokenizer(texts, return_tensors="pt").to(
-        prompt_enhancer_model.device
+    model_inputs = _tokenize_chat(
+        prompt_enhancer_tokenizer,
+        system_prompt,
+        [f"user_prompt: {p}" for p in prompts],
+        prompt_enhancer_model.device,
     )
 
     return _generate_and_decode_prompts(
-        prompt_enhancer_model, prompt_enhancer_tokenizer, model_inputs, max_new_tokens
+        prompt_enhancer_model,
+        prompt_enhancer_tokenizer,
+        model_inputs,
+        max_new_tokens,
+        static_cache,
     )
 
 def _generate_i2v_prompt(
-    image_caption_model,
-    image_caption_processor,
     prompt_enhancer_model,
     prompt_enhancer_tokenizer,
     prompts: List[str],
-    first_frames: List[Image.Image],
+    image_captions: List[str],
     max_new_tokens: int,
     system_prompt: str,
+    static_cache: Optional[StaticCache] = None,
 ) -> List[str]:
-    image_captions = _generate_image_captions(
-        image_caption_model, image_caption_processor, first_frames
-    )
-
-    messages = [
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"user_prompt: {p}\nimage_caption: {c}"},
-        ]
-        for p, c in zip(prompts, image_captions)
-    ]
-
-    texts = [
-        prompt_enhancer_tokenizer.apply_chat_template(
-            m, tokenize=False, add_generation_prompt=True
-        )
-        for m in messages
-    ]
-    model_inputs = prompt_enhancer_tokenizer(texts, return_tensors="pt").to(
-        prompt_enhancer_model.device
+    model_inputs = _tokenize_chat(
+        prompt_enhancer_tokenizer,
+        system_prompt,
+        [f"user_prompt: {p}\nimage_caption: {c}" for p, c in zip(prompts, image_captions)],
+        prompt_enhancer_model.device,
     )
 
     return _generate_and_decode_prompts(
-        prompt_enhancer_model, prompt_enhancer_tokenizer, model_inputs, max_new_tokens
+        prompt_enhancer_model,
+        prompt_enhancer_tokenizer,
+        model_inputs,
+        max_new_tokens,
+        static_cache,
     )
 
+def _get_caption_prompt_ids(image_caption_processor, prompt: str) -> torch.Tensor:
+    key = (id(image_caption_processor), prompt)
+    input_ids = _caption_prompt_cache.get(key)
+    if input_ids is None:
+        # Florence-2 处理器会把任务 token（如 <DETAILED_CAPTION>）展开成完整的提问文本。
+        # 公开接口必须同时传图像，用一张 1x1 的占位图，只取文本部分；展开结果和图像无关，只算一次
+        input_ids = image_caption_processor(
+            text=[prompt], images=[Image.new("RGB", (1, 1))], return_tensors="pt"
+        )["input_ids"]
+        _caption_prompt_cache[key] = input_ids
+    return input_ids
+
+def _preprocess_images_on_device(
+    image_caption_processor, images: torch.Tensor
+) -> Optional[torch.Tensor]:
+    """
+    Resize and normalize [B, C, H, W] frames in [-1, 1] on their own device, like the processor's CLIPImageProcessor would.
+    Returns None when the processor configuration is not supported here.
+    """
+    image_processor = getattr(image_caption_processor, "image_processor", None)
+    if image_processor is None:
+        logger.debug("Image captioner processor has no image_processor, using the PIL path")
+        return None
+    size = getattr(image_processor, "size", None) or {}
+    if "height" not in size or "width" not in size or images.shape[1] != 3:
+        logger.debug("Unsupported size %s or channel count %d, using the PIL path", size, images.shape[1])
+        return None
+    # 下面只实现了 bicubic 缩放和 1/255 的 rescale，其他配置交给处理器自己的 PIL 流程
+    if getattr(image_processor, "do_center_crop", False):
+        logger.debug("Image processor center-crops, using the PIL path")
+        return None
+    if not getattr(image_processor, "do_rescale", True) or getattr(image_processor, "rescale_factor", 1 / 255) != 1 / 255:
+        logger.debug("Image processor does not rescale by 1/255, using the PIL path")
+        return None
+    resample = getattr(image_processor, "resample", None)
+    if getattr(image_processor, "do_resize", True) and (resample is None or int(resample) != int(Image.BICUBIC)):
+        logger.debug("Image processor resamples with %s instead of bicubic, using the PIL path", resample)
+        return None
+
+    pixels = images.to(torch.float32).clamp(-1, 1).add_(1).mul_(0.5)
+    if getattr(image_processor, "do_resize", True):
+        pixels = F.interpolate(
+            pixels,
+            size=(size["height"], size["width"]),
+            mode="bicubic",
+            align_corners=False,
+            antialias=True,
+        ).clamp_(0, 1)
+    if getattr(image_processor, "do_normalize", True):
+        mean = torch.tensor(image_processor.image_mean, device=pixels.device).view(1, -1, 1, 1)
+        std = torch.tensor(image_processor.image_std, device=pixels.device).view(1, -1, 1, 1)
+        pixels = pixels.sub_(mean).div_(std)
+    return pixels
+
 def _generate_image_captions(
     image_caption_model,
     image_caption_processor,
-    images: List[Image.Image],
+    images: torch.Tensor,
     system_prompt: str = "<DETAILED_CAPTION>",
+    max_new_tokens: int = 128,
+    num_beams: int = 1,
 ) -> List[str]:
     image_caption_prompts = [system_prompt] * len(images)
-    inputs = image_caption_processor(
-        image_caption_prompts, images, return_tensors="pt"
-    ).to(image_caption_model.device)
-
     dtype = next(image_caption_model.parameters()).dtype
-    inputs["pixel_values"] = inputs["pixel_values"].to(dtype=dtype)
-
-    with torch.inference_mode():
-        generated_ids = image_caption_model.generate(
-            input_ids=inputs["input_ids"],
-            pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024,
-            do_sample=False,
-            num_beams=3,
+
+    pixel_values = _preprocess_images_on_device(image_caption_processor, images)
+    if pixel_values is not None:
+        input_ids = (
+            _get_caption_prompt_ids(image_caption_processor, system_prompt)
+            .to(image_caption_model.device)
+            .expand(len(images), -1)
         )
+    else:
+        # 处理器配置和上面的实现不一致或图像不是 RGB 时，回退到处理器自带的 PIL 流程
+        inputs = image_caption_processor(
+            image_caption_prompts, [tensor_to_pil(image) for image in images], return_tensors="pt"
+        ).to(image_caption_model.device)
+        input_ids = inputs["input_ids"]
+        pixel_values = inputs["pixel_values"]
+    pixel_values = pixel_values.to(dtype=dtype)
+
+    # early_stopping 只对 beam search 有意义，贪心解码时传入会触发 GenerationConfig 警告
+    beam_kwargs = {"early_stopping": True} if num_beams > 1 else {}
+    generated_ids = image_caption_model.generate(
+        input_ids=input_ids,
+        pixel_values=pixel_values,
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        num_beams=num_beams,
+        **beam_kwargs,
+    )
 
     return image_caption_processor.batch_decode(generated_ids, skip_special_tokens=True)
 
-def _get_random_scene_type():
+SCENE_TYPES = (
+    "The scene is captured in real-life footage.",
+    "The scene is computer-generated imagery.",
+    "The scene appears to be from a movie.",
+    "The scene appears to be from a TV show.",
+    "The scene is captured in a studio.",
+)
+
+def _get_random_scene_types(k: int) -> List[str]:
     """
-    Randomly select a scene type to add to the prompt.
+    Randomly select k scene types to add to the prompts.
     """
-    types = [
-        "The scene is captured in real-life footage.",
-        "The scene is computer-generated imagery.",
-        "The scene appears to be from a movie.",
-        "The scene appears to be from a TV show.",
-        "The scene is captured in a studio.",
-    ]
-    return random.choice(types)
+    return random.choices(SCENE_TYPES, k=k)
 
 def _generate_and_decode_prompts(
-    prompt_enhancer_model, prompt_enhancer_tokenizer, model_inputs, max_new_tokens: int
+    prompt_enhancer_model,
+    prompt_enhancer_tokenizer,
+    model_inputs,
+    max_new_tokens: int,
+    static_cache: Optional[StaticCache] = None,
 ) -> List[str]:
-    with torch.inference_mode():
-        outputs = prompt_enhancer_model.generate(
-            **model_inputs, max_new_tokens=max_new_tokens
-        )
-        generated_ids = [
-            output_ids[len(input_ids) :]
-            for input_ids, output_ids in zip(model_inputs.input_ids, outputs)
-        ]
-        decoded_prompts = prompt_enhancer_tokenizer.batch_decode(
-            generated_ids, skip_special_tokens=True
-        )
+    # 预先分配好的固定大小 KV cache 让编译后的 decode step 形状固定，避免重复编译。
+    # 只有放得下这一批（batch 大小和总长度）时才使用，否则退回默认的动态 cache
+    input_length = model_inputs["input_ids"].shape[1]
+    generate_kwargs = {}
+    if (
+        static_cache is not None
+        and model_inputs["input_ids"].shape[0] == static_cache.max_batch_size
+        and input_length + max_new_tokens <= static_cache.max_cache_len
+    ):
+        static_cache.reset()
+        generate_kwargs["past_key_values"] = static_cache
+    outputs = prompt_enhancer_model.generate(
+        **model_inputs,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=prompt_enhancer_tokenizer.pad_token_id,
+        **generate_kwargs,
+    )
+
+    # 左侧补齐后每一行的输入长度相同，新 token 都从同一位置开始
+    generated_ids = outputs[:, input_length:]
+    decoded_prompts = prompt_enhancer_tokenizer.batch_decode(
+        generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
 
-    decoded_prompts = [p + f" {_get_random_scene_type()}." for p in decoded_prompts]
+    # 场景描述本身已经以句号结尾，不再额外加 "."
+    scene_types = _get_random_scene_types(len(decoded_prompts))
+    decoded_prompts = [f"{p} {t}" for p, t in zip(decoded_prompts, scene_types)]
 
-    print(decoded_prompts)
+    logger.debug("Enhanced prompts: %s", decoded_prompts)
 
     return decoded_prompts
\ No newline at end of file